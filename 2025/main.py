@@ -1,8 +1,16 @@
 from datetime import datetime, timedelta
 import json
+import csv
+from collections import Counter
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
 import requests
 import os
 
+# Shared session so requests for multiple addresses reuse the same connection
+SESSION = requests.Session()
+
 # Fill these out with addresses you want to get data for
 osmosis_address = [
     {
@@ -14,153 +22,113 @@ osmosis_address = [
 
 def main():
 
-    eth_date_prices = {}
-    with open("reference_data/ethereum_2024-01-01_2024-12-31.csv", "r") as f:
-        lines = f.readlines()
-        for line in lines[1:]:
-            line = line.strip().split(",")
-            date = line[0]
-            op = float(line[2])
-            high = float(line[3])
-            low = float(line[4])
-            close = float(line[5])
-            eth_date_prices[date] = {
-                "open": op,
-                "high": high,
-                "low": low,
-                "close": close,
-            }
+    eth_date_prices = parse_price_csv("reference_data/ethereum_2024-01-01_2024-12-31.csv")
+    osmo_price_data = parse_price_csv("reference_data/osmosis_2024-01-01_2024-12-31.csv")
 
-    osmo_price_data = {}
-    with open("reference_data/osmosis_2024-01-01_2024-12-31.csv", "r") as f:
-        lines = f.readlines()
-        for line in lines[1:]:
-            line = line.strip().split(",")
-            date = line[0]
-            op = float(line[2])
-            high = float(line[3])
-            low = float(line[4])
-            close = float(line[5])
-            osmo_price_data[date] = {
-                "open": op,
-                "high": high,
-                "low": low,
-                "close": close,
-            }
-
-    if not os.path.exists("interim_data"):
-        os.makedirs("interim_data")
+    os.makedirs("interim_data", exist_ok=True)
 
+    # Compact separators keep the interim price dumps small
     with open("interim_data/eth_prices_parsed.json", "w") as jf:
-        jf.write(json.dumps(eth_date_prices))
+        jf.write(json.dumps(eth_date_prices, separators=(",", ":")))
 
     with open("interim_data/osmo_prices_parsed.json", "w") as jf:
-        jf.write(json.dumps(osmo_price_data))
+        jf.write(json.dumps(osmo_price_data, separators=(",", ":")))
 
     eth_lines = []
-    with open("reference_data/eth_val_table_dump.txt", "r") as f:
-        lines = f.readlines()
 
-        # lines are chunked as follows:
-        # 1. epoch
-        # 2. block height
-        # 3. days and hours ago
-        # 4. validator account
-        # 5. ETH withdrawn
-        # We want to change the text file into a CSV
-        # The date needs to be changed into a date string instead of days ago
-        dates = {}
+    # lines are chunked as follows:
+    # 1. epoch
+    # 2. block height
+    # 3. days and hours ago
+    # 4. validator account
+    # 5. ETH withdrawn
+    # We want to change the text file into a CSV
+    # The date needs to be changed into a date string instead of days ago
+    dates = {}
+
+    # Stream the dump straight into the CSV, only the current chunk is held in memory
+    with open("reference_data/eth_val_table_dump.txt", "r") as dump_f, open("interim_data/eth_val_table_dump.csv", "w") as f:
+        lines = iter(dump_f)
+        now = datetime.now()
+        writer = csv.writer(f, lineterminator="\n")
+
+        # Write the header
+        writer.writerow(["epoch", "slot", "date", "validator account", "ETH withdrawn"])
+
+        # Write the data
+        for epoch in lines:
+            epoch = epoch.strip()
+            slot = next(lines).strip()
+            days_ago = next(lines).strip()
+
+            # Convert days ago to a date string
+            days_ago = days_ago.split(" ")
+            days = int(days_ago[0])
+            hours = int(days_ago[2])
+
+            # Convert days and hours to a date string
+            date = now - timedelta(days=days, hours=hours)
+            dateStr = date.strftime("%Y-%m-%d %H:%M:%S")
+
+            validator_account = next(lines).strip()
+            eth_withdrawn = next(lines).strip()
+            eth_amount = float(eth_withdrawn.split(" ", 1)[0])
+
+            writer.writerow([epoch, slot, dateStr, validator_account, eth_withdrawn])
+
+            # Keep the day and the parsed amount alongside the row, they are used for price lookups and grouping later on
+            eth_lines.append([epoch, slot, date, dateStr[:10], validator_account, eth_amount])
+
+    with open("interim_data/dates.txt", "w") as f:
+        for date in dates:
+            f.write(f"{date}\n")
+
+    # The validator dump is ordered by time, so withdrawals on the same day are adjacent
+    eth_lines_combined = []
+    for date_str, day_lines in groupby(eth_lines, key=itemgetter(3)):
+        day_lines = list(day_lines)
+        eth_lines_combined.append(
+            {
+                "date": date_str,
+                "full_date": day_lines[0][2],
+                "eth_withdrawn": sum(line[5] for line in day_lines),
+                "epoch": day_lines[0][0],
+            }
+        )
 
-        with open("interim_data/eth_val_table_dump.csv", "w") as f:
+    # Only the daily high is used to value withdrawals
+    eth_high_prices = {date: prices["high"] for date, prices in eth_date_prices.items()}
 
-            # Write the header
-            f.write("epoch,slot,date,validator account,ETH withdrawn\n")
-
-            # Write the data
-            for i in range(0, len(lines), 5):
-                epoch = lines[i].strip()
-                slot = lines[i + 1].strip()
-                days_ago = lines[i + 2].strip()
-
-                # Convert days ago to a date string
-                days_ago = days_ago.split(" ")
-                days = int(days_ago[0])
-                hours = int(days_ago[2])
-
-                # Convert days and hours to a date string
-                date = datetime.now() - timedelta(days=days, hours=hours)
-                dateStr = date.strftime("%Y-%m-%d %H:%M:%S")
-
-                validator_account = lines[i + 3].strip()
-                eth_withdrawn = lines[i + 4].strip()
-
-                f.write(
-                    f"{epoch},{slot},{dateStr},{validator_account},{eth_withdrawn}\n"
-                )
-
-                eth_lines.append([epoch, slot, date, validator_account, eth_withdrawn])
-
-        with open("interim_data/dates.txt", "w") as f:
-            for date in dates:
-                f.write(f"{date}\n")
-
-    eth_lines_combined = [
-        {
-            "date": eth_lines[0][2].strftime("%Y-%m-%d"),
-            "full_date": eth_lines[0][2],
-            "eth_withdrawn": float(eth_lines[0][4].split(" ")[0]),
-            "epoch": eth_lines[0][0],
-        }
-    ]
-
-    for line in eth_lines:
-
-        if line[2].strftime("%Y-%m-%d") == eth_lines_combined[-1]["date"]:
-            eth_lines_combined[-1]["eth_withdrawn"] += float(line[4].split(" ")[0])
-        else:
-            eth_lines_combined.append(
-                {
-                    "date": line[2].strftime("%Y-%m-%d"),
-                    "full_date": line[2],
-                    "eth_withdrawn": float(line[4].split(" ")[0]),
-                    "epoch": line[0],
-                }
-            )
-
-    eth_out = []    
+    eth_out = []
     with open("interim_data/eth_out_split.csv", "w") as f:
-        f.write("timeReceived,currencyReceived,quantityReceived,usdValue\n")
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["timeReceived", "currencyReceived", "quantityReceived", "usdValue"])
         for line in eth_lines:
             if line[2].year != 2024:
                 continue
-            dateStr = line[2].strftime("%Y-%m-%d")
-            ethPrice = eth_date_prices[dateStr]["high"]
-            ethAmount = float(line[4].split(" ")[0])
-            ethValue = "{:.2f}".format(round(ethAmount * ethPrice, 2))
+            dateStr = line[3]
+            ethAmount = line[5]
+            ethValue = f"{ethAmount * eth_high_prices[dateStr]:.2f}"
             epoch = line[0]
             eth_out.append([dateStr, "ETH", ethAmount, ethValue, f"ETH epoch: {epoch}"])
-            f.write(f"{line[2]},ETH,{ethAmount},{ethValue}\n")
+            writer.writerow([line[2], "ETH", ethAmount, ethValue])
 
     with open("interim_data/eth_out_combined.csv", "w") as f:
-        f.write("timeReceived,currencyReceived,quantityReceived,usdValue\n")
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["timeReceived", "currencyReceived", "quantityReceived", "usdValue"])
         for line in eth_lines_combined:
             if line["full_date"].year != 2024:
                 continue
             dateStr = line["date"]
-            ethPrice = eth_date_prices[dateStr]["high"]
-            ethAmount = float(line["eth_withdrawn"])
-            ethValue = "{:.2f}".format(round(ethAmount * ethPrice, 2))
-            f.write(f"{dateStr},ETH,{ethAmount},{ethValue}\n")
+            ethAmount = line["eth_withdrawn"]
+            ethValue = f"{ethAmount * eth_high_prices[dateStr]:.2f}"
+            writer.writerow([dateStr, "ETH", ethAmount, ethValue])
 
-    if not os.path.exists("output_data"):
-        os.makedirs("output_data")
+    os.makedirs("output_data", exist_ok=True)
 
     for address in osmosis_address:
         # check if file is already in interim data
-        try:
-            with open(f"interim_data/{address['address']}.csv", "r") as f:
-                pass
-        except FileNotFoundError:
+        if not os.path.exists(f"interim_data/{address['address']}.csv"):
             get_osmosis_csv(address["address"])
 
         address_lines = []
@@ -169,45 +137,68 @@ def main():
 
             # Write the header
             with open(f"interim_data/{address['address']}_parsed.csv", "w") as f:
-                f.write("timeReceived,currencyReceived,quantityReceived,usdValue,operationId\n")
+                writer = csv.writer(f, lineterminator="\n")
+                writer.writerow(["timeReceived", "currencyReceived", "quantityReceived", "usdValue", "operationId"])
 
                 for line in lines[1:]:
                     line = line.strip().split(",")
 
                     if line[0] == "withdraw" and line[8] == "staked":
 
-                        date = line[1]
-                        parsed_date = datetime.strptime(date, "%m/%d/%Y %H:%M:%S")
+                        # Only the day matters for pricing, drop the time before parsing
+                        parsed_date = parse_osmosis_date(line[1].split(" ", 1)[0])
                         if parsed_date.year != 2024:
                             continue
 
-                        date_str = parsed_date.strftime("%Y-%m-%d")
+                        date_str = parsed_date.isoformat()
                         quantity = line[2]
                         currency = line[3]
                         operationId = line[9]
 
                         usd_value = "{:.2f}".format(round(osmo_price_data[date_str]['high'] * float(quantity)))
 
-                        f.write(f"{date_str},{currency},{quantity},{usd_value},{operationId}\n")
+                        writer.writerow([date_str, currency, quantity, usd_value, operationId])
                         address_lines.append([date_str, currency, quantity, usd_value, f"OSMO TX: {operationId}"])
 
         with open(f"output_data/{address['name']}_parsed.csv", "w") as f:
-            f.write("timeReceived,currencyReceived,quantityReceived,usdValue,operationId\n")
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(["timeReceived", "currencyReceived", "quantityReceived", "usdValue", "operationId"])
 
             if address["name"] == "BryanVentures":
-                address_lines = address_lines + eth_out
-                address_lines = sorted(address_lines, key=lambda x: datetime.strptime(x[0], "%Y-%m-%d"))
+                # Dates are ISO formatted, so they already sort chronologically as strings.
+                # Sorting in place lets Timsort merge the ordered runs each source arrives in
+                address_lines.extend(eth_out)
+                address_lines.sort(key=itemgetter(0))
 
-            symbol_totals = {}
+            symbol_totals = Counter()
             for line in address_lines:
-                if line[1] not in symbol_totals:
-                    symbol_totals[line[1]] = 0
                 symbol_totals[line[1]] += float(line[3])
-                f.write(f"{line[0]},{line[1]},{line[2]},{line[3]},{line[4]}\n")
+            writer.writerows(address_lines)
 
-            f.write("\n")
+            writer.writerow([])
             for symbol in symbol_totals:
-                f.write(f"{symbol},{'{:.2f}'.format(round(symbol_totals[symbol], 2))}\n")
+                writer.writerow([symbol, '{:.2f}'.format(round(symbol_totals[symbol], 2))])
+
+def parse_price_csv(fname):
+
+    # Price exports are laid out as Start,End,Open,High,Low,Close,Volume,Market Cap
+    with open(fname, "r", newline="") as f:
+        reader = csv.reader(f)
+        next(reader)
+        return {
+            line[0]: {
+                "open": float(line[2]),
+                "high": float(line[3]),
+                "low": float(line[4]),
+                "close": float(line[5]),
+            }
+            for line in reader
+        }
+
+# Rewards are withdrawn many times a day, so each distinct day only goes through strptime once
+@lru_cache(maxsize=None)
+def parse_osmosis_date(day):
+    return datetime.strptime(day, "%m/%d/%Y").date()
 
 def get_osmosis_csv(address):
 
@@ -218,12 +209,14 @@ def get_osmosis_csv(address):
         "format": "accointing"
     }
 
-    response = requests.post(url, data=json.dumps(data), headers={"Content-Type": "application/json"}, timeout=None)
+    # Stream the export straight to disk in chunks instead of holding the whole CSV in memory
+    with SESSION.post(url, data=json.dumps(data), headers={"Content-Type": "application/json"}, timeout=None, stream=True) as response:
 
-    response.raise_for_status()
+        response.raise_for_status()
 
-    with open(f"interim_data/{address}.csv", "w") as f:
-        f.write(response.text)
+        with open(f"interim_data/{address}.csv", "wb") as f:
+            for chunk in response.iter_content(chunk_size=65536):
+                f.write(chunk)
 
 
 if __name__ == "__main__":
@@ -1,4 +1,6 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import sys
 import json
@@ -6,17 +8,24 @@ import argparse
 from openpyxl import load_workbook
 from openpyxl.utils.exceptions import InvalidFileException
 from os.path import exists
+import os
 from openpyxl import Workbook
 from openpyxl.utils import get_column_letter
 import datetime
 import traceback
 import pydoc
 import csv
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 
 COIN_GECKO_API_URL = "https://api.coingecko.com/api/v3"
 COIN_GECKO_COINS_ENDPOINT = "/coins"
-COIN_GECKO_HISTORICAL_ENDPOINT = "/<coin-id>/history"
+COIN_GECKO_HISTORICAL_ENDPOINT = "/{coin_id}/history"
+COIN_GECKO_MARKET_CHART_RANGE_ENDPOINT = "/{coin_id}/market_chart/range"
+COIN_GECKO_MARKET_CHART_RANGE_PARAMS = "?vs_currency=usd&from={from_time}&to={to_time}"
 COIN_GECKO_COINS_LIST_ENDPOINT = "/list"
+#the coin list rarely changes, so a cached copy is reused for a day before fetching it again
+COIN_GECKO_COINS_LIST_CACHE_TIME = 86400
 
 #this represents CoinGecko's 50 requests/minute API rate limit, plus some seconds for variance
 COIN_GECKO_REQUEST_CHUNKS = 9
@@ -24,15 +33,96 @@ COIN_GECKO_THROTTLE_TIME = 61
 
 #this represents throttling for Coinhall, which will throttle after every single request
 COINHALL_THROTTLE_TIME = 10
+#Coinhall requests in flight at once, still spaced out by COINHALL_THROTTLE_TIME
+COINHALL_REQUEST_WORKERS = 4
 COINHALL_API_URL = "https://api.coinhall.org/api/v1"
 COINHALL_CHART_ENDPOINT = "/charts/terra/candles"
-COINHALL_HISTORICAL_PARAMS = "?bars=1&from=<from-time>&to=<to-time>&quoteAsset=uusd&interval=1d&pairAddress=<coin-id>"
+COINHALL_HISTORICAL_PARAMS = "?bars=1&from={from_time}&to={to_time}&quoteAsset=uusd&interval=1d&pairAddress={coin_id}"
 
 KEY_CLASSIFICATIONS = ["staked", "airdrop"]
 
+#one shared session so repeated CoinGecko/Coinhall calls reuse keep-alive connections instead of a new TCP+TLS handshake per request
+#only transient connection and server errors are retried here, 429s are left to the self-throttling logic in process_rows
+SESSION = requests.Session()
+SESSION.headers.update({"Accept": "application/json"})
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=20, max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504], respect_retry_after_header=False, raise_on_status=False)))
+
+#seconds to wait on a connection or response before treating the request as failed, so a stalled socket cannot hang the run
+REQUEST_TIMEOUT = 30
+
 class CaughtError(Exception):
     pass
 
+#self-throttling to stay under CoinGecko throttle limits, shared by every thread making CoinGecko requests
+#a token bucket holding up to COIN_GECKO_REQUEST_CHUNKS requests that refills at that many per COIN_GECKO_THROTTLE_TIME,
+#so requests go out as soon as a token is available instead of in bursts followed by an idle wait for the window to end
+class CoinGeckoThrottle:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = COIN_GECKO_REQUEST_CHUNKS
+        self.last_refill = time.monotonic()
+        self.blocked_until = 0
+        self.stopped = threading.Event()
+
+    #call before every request made to CoinGecko, blocks until the request is allowed to go out
+    def acquire(self):
+        while True:
+            with self.lock:
+                self.raise_if_stopped()
+                now = time.monotonic()
+
+                #a backoff started by any thread holds back every request until it is over
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                else:
+                    self.tokens = min(COIN_GECKO_REQUEST_CHUNKS, self.tokens + (now - self.last_refill) * COIN_GECKO_REQUEST_CHUNKS / COIN_GECKO_THROTTLE_TIME)
+                    self.last_refill = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) * COIN_GECKO_THROTTLE_TIME / COIN_GECKO_REQUEST_CHUNKS
+
+            #wait without the lock so another thread can start a backoff, then check again
+            self.stopped.wait(delay)
+
+    #after a failed request, stop all CoinGecko traffic for a full throttle window, then start again from a full bucket
+    #requests that fail while a backoff is already running join it, so the bucket is only refilled once per backoff
+    def backoff(self):
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.blocked_until:
+                self.blocked_until = now + COIN_GECKO_THROTTLE_TIME
+                self.tokens = COIN_GECKO_REQUEST_CHUNKS
+                self.last_refill = self.blocked_until
+
+    #makes every thread waiting on or retrying through this throttle give up, e.g. when the run is interrupted
+    def stop(self):
+        self.stopped.set()
+
+    def raise_if_stopped(self):
+        if self.stopped.is_set():
+            raise CaughtError("CoinGecko requests were stopped")
+
+#self-throttling for Coinhall, sends are at least COINHALL_THROTTLE_TIME apart
+class CoinhallThrottle:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_request = None
+        self.stopped = threading.Event()
+
+    #call before every request made to Coinhall, blocks until the request is allowed to go out
+    def acquire(self):
+        with self.lock:
+            if self.last_request is not None:
+                self.stopped.wait(max(0, COINHALL_THROTTLE_TIME - (time.monotonic() - self.last_request)))
+            if self.stopped.is_set():
+                raise CaughtError("Coinhall requests were stopped")
+            self.last_request = time.monotonic()
+
+    #makes waiting threads give up instead of sending
+    def stop(self):
+        self.stopped.set()
+
 def parse_args(process_function, import_symbol_function):
     parser = argparse.ArgumentParser(description='A command line tool to process CSV/XLSX files of Crypto Symbols and amounts and gather USD value')
     subparser = parser.add_subparsers()
@@ -55,6 +145,7 @@ def parse_args(process_function, import_symbol_function):
     parser_import_symbol.add_argument('symbol', help='The symbol to import. Options will be chosen that closely match this symbol and the CoinGecko IDs will be saved to your configuration file.')
     parser_import_symbol.add_argument("--type", choices=["coingecko"], help='The config file type, used to gather ID lists for giving choices.', required=True)
     parser_import_symbol.add_argument('--config-file', '-cf', help='The location of your JSON config file that stores symbols to ID configurations for making API requests', required=True)
+    parser_import_symbol.add_argument('--coins-list-cache', '-cl-c', help='The JSON file holding the cached CoinGecko coin list (refreshed once it is a day old)', default="./.coingecko_coins_list.json", type=str)
 
     args = parser.parse_args()
     return args
@@ -83,51 +174,109 @@ def get_coingecko_cache(coingecko_cache_file):
         print(f"No CoinGecko price cache file found at {coingecko_cache_file}, creating...")
         with open(coingecko_cache_file, 'w') as fp:
             json.dump({}, fp)
-        return {}
+        coingecko_cache = {}
     else:
         print(f"Found CoinGecko cache file {coingecko_cache_file}, loading...")
-        return json.load(open(coingecko_cache_file))
+        with open(coingecko_cache_file) as fp:
+            coingecko_cache = json.load(fp)
+
+    #replay entries a previous run appended but never compacted into the cache file, e.g. because it was interrupted
+    journal_file = get_coingecko_cache_journal_file(coingecko_cache_file)
+    if exists(journal_file):
+        print(f"Found unsaved CoinGecko cache entries in {journal_file}, loading...")
+        with open(journal_file) as fp:
+            for line in fp:
+                #a line without its newline was cut off mid-write, everything before it is intact
+                if not line.endswith("\n"):
+                    break
+                entry = json.loads(line)
+                coingecko_cache.setdefault(entry["symbol"], {})[entry["date"]] = entry["usd"]
+
+        #fold the replayed entries into the cache file so this run starts appending to a fresh journal
+        write_coingecko_cache(coingecko_cache, coingecko_cache_file)
+
+    return coingecko_cache
+
+#new cache entries are appended to a JSON lines journal next to the cache file, so each write costs the same no matter how big the cache gets
+#the suffix is appended rather than swapped for the extension, so the journal can never end up being the cache file itself
+def get_coingecko_cache_journal_file(coingecko_cache_file):
+    return coingecko_cache_file + ".journal"
+
+def append_coingecko_cache(symbol, date, cost, coingecko_cache_file):
+    with open(get_coingecko_cache_journal_file(coingecko_cache_file), 'a') as fp:
+        fp.write(json.dumps({"symbol": symbol, "date": date, "usd": cost}) + "\n")
 
+#rewrites the full cache file and drops the journal, whose entries are now part of it
 def write_coingecko_cache(data, coingecko_cache_file):
+    #compact separators keep the cache file small, and a single dumps() call uses the C encoder where json.dump() does not
     with open(coingecko_cache_file, 'w') as fp:
-        json.dump(data, fp)
+        fp.write(json.dumps(data, separators=(",", ":")))
+
+    journal_file = get_coingecko_cache_journal_file(coingecko_cache_file)
+    if exists(journal_file):
+        os.remove(journal_file)
 
 def load_config_file(fname):
-    return json.load(open(fname))
+    with open(fname) as fp:
+        return json.load(fp)
 
 def save_config_file(fname, config_value):
-    return json.dump(config_value, open(fname, 'w'), indent=4)
+    with open(fname, 'w') as fp:
+        json.dump(config_value, fp, indent=4)
 
 def parse_input_data(fname):
     print("Loading data from Excel file")
     wb = None
     try:
-        wb = load_workbook(filename=fname)
+        #read-only mode streams the sheet XML instead of building every cell object up front
+        wb = load_workbook(filename=fname, read_only=True, data_only=True)
     except InvalidFileException:
         raise CaughtError(f"Input file '{fname}' is not in the correct Excel format, please check your file and try again")
 
     ws = wb.active
-    rows = ws.rows
-    headers = [c.value for c in next(rows)]
     active_sheet_name = ws.title
-    return active_sheet_name, headers, [row for row in iter_worksheet(ws)]
 
-def iter_worksheet(worksheet):
     # It's necessary to get a reference to the generator, as 
-    # `worksheet.rows` returns a new iterator on each access.
-    rows = worksheet.rows
+    # `worksheet.iter_rows` returns a new iterator on each call.
+    # values_only yields plain tuples of cell values instead of building a cell object per value
+    rows = ws.iter_rows(values_only=True)
+    headers = list(next(rows))
+
+    #rows are kept as plain value tuples, only the key rows are turned into dicts later on
+    data = list(rows)
 
-    # Get the header values as keys and move the iterator to the next item
-    keys = [c.value for c in next(rows)]
-    for row in rows:
-        values = [c.value for c in row]
-        yield dict(zip(keys, values))
+    #read-only workbooks keep the file handle open until closed
+    wb.close()
+    return active_sheet_name, headers, data
 
-def get_key_data_point_indexes(rows, dateColumn, yearFilter):
+#yields (index, row dict) for the rows that need pricing, every other row is only needed as-is for the full output
+def stream_key_rows(row_values, headers, dateColumn, yearFilter):
     print("Gathering key data points for classifications", KEY_CLASSIFICATIONS)
-    return [index for index, row in enumerate(rows) if "classification" in row and row["classification"] in KEY_CLASSIFICATIONS and row[dateColumn].year == yearFilter and row["boughtCurrency"]]
+    #set lookup and a single .get per row, the classification check rules out most rows so it goes first
+    key_classifications = set(KEY_CLASSIFICATIONS)
+    for index, values in enumerate(row_values):
+        row = dict(zip(headers, values))
+        if row.get("classification") in key_classifications and row[dateColumn].year == yearFilter and row["boughtCurrency"]:
+            yield index, row
+
+#the full output lists every input row, key rows carry their usdValue and the rest are mapped to dicts one at a time as they are written
+def iter_output_rows(row_values, headers, key_rows):
+    for index, values in enumerate(row_values):
+        if index in key_rows:
+            yield key_rows[index]
+        else:
+            yield dict(zip(headers, values))
 
-def process_rows(rows, key_data_point_indexes, coingecko_symbols_to_id_configs, coinhall_symbols_to_id_configs, date_column, symbolColumn, valueColumn, simplified_rows_headers, coingecko_cache, coingecko_cache_file):
+#dd-mm-yyyy keys for the CoinGecko lookups, built once per key row
+#formatting the date fields directly is several times cheaper than strftime
+def get_date_keys(rows, key_data_point_indexes, date_column):
+    date_keys = {}
+    for i in key_data_point_indexes:
+        date = rows[i][date_column]
+        date_keys[i] = f"{date.day:02d}-{date.month:02d}-{date.year}"
+    return date_keys
+
+def process_rows(rows, key_data_point_indexes, date_keys, coingecko_symbols_to_id_configs, coinhall_symbols_to_id_configs, date_column, symbolColumn, valueColumn, simplified_rows_headers, coingecko_cache, coingecko_cache_file):
 
     print(f"Processing {len(key_data_point_indexes)} rows that matched the metric")
 
@@ -136,130 +285,103 @@ def process_rows(rows, key_data_point_indexes, coingecko_symbols_to_id_configs,
     #build data structure storing symbols to dates to row indexes
     #used for ease-of-access and processing
     for i in key_data_point_indexes:
-        row = rows[i]
-        boughtCurrency = row[symbolColumn]
-        if boughtCurrency not in symbols_to_dates_to_rows:
-            symbols_to_dates_to_rows[boughtCurrency] = {}
-
-        date_key = row[date_column].strftime("%d-%m-%Y")
+        boughtCurrency = rows[i][symbolColumn]
+        symbols_to_dates_to_rows.setdefault(boughtCurrency, {}).setdefault(date_keys[i], []).append(i)
 
-        if date_key not in symbols_to_dates_to_rows[boughtCurrency]:
-            symbols_to_dates_to_rows[boughtCurrency][date_key] = [i]
-        else:
-            symbols_to_dates_to_rows[boughtCurrency][date_key].append(i)
-
-    symbols_to_dates_to_costs = {}
+    #costs are keyed by (symbol, date) so looking one up is a single hash
+    symbol_date_costs = {}
 
     #gather the cached CoinGecko costs so we dont attempt to grab them again
     print("Checking CoinGecko cache file for cached data...")
-    num_cached = 0
-    for symbol in symbols_to_dates_to_rows:
-        for date in symbols_to_dates_to_rows[symbol]:
-            if symbol in coingecko_cache and date in coingecko_cache[symbol]:
-                num_cached += 1
-                if symbol not in symbols_to_dates_to_costs:
-                    symbols_to_dates_to_costs[symbol] = {}
-                symbols_to_dates_to_costs[symbol][date] = coingecko_cache[symbol][date]
+    for symbol, dates in symbols_to_dates_to_rows.items():
+        symbol_cache = coingecko_cache.get(symbol, {})
+        for date in dates:
+            if date in symbol_cache:
+                symbol_date_costs[(symbol, date)] = symbol_cache[date]
 
+    num_cached = len(symbol_date_costs)
     if num_cached > 0:
         print(f"Found {num_cached} entries, these will be skipped when reaching out to CoinGecko")
     else:
         print(f"No cached entries found, all data needs to be retrieved")
 
-    #remove the cached entries
-    for symbol in symbols_to_dates_to_costs:
-        for date in symbols_to_dates_to_costs[symbol]:
-            del symbols_to_dates_to_rows[symbol][date]
-        # if len(symbols_to_dates_to_rows[symbol].keys()) == 0:
-        #     del symbols_to_dates_to_rows[symbol]
+    #remove the cached entries, and symbols that have nothing left to fetch
+    for symbol, date in symbol_date_costs:
+        del symbols_to_dates_to_rows[symbol][date]
+    symbols_to_dates_to_rows = {symbol: dates for symbol, dates in symbols_to_dates_to_rows.items() if dates}
     
     #loop through chunks of data and send to API for processing
     print("Reaching out to CoinGecko for symbol cost data, this may take a while...")
 
-    coingecko_requests_made = 0
-    for symbol in symbols_to_dates_to_rows:
+    throttle = CoinGeckoThrottle()
 
-        if symbol not in symbols_to_dates_to_costs:
-                symbols_to_dates_to_costs[symbol] = {}
+    #a single market chart request covers every date needed for a symbol
+    #these requests are independent, so they are made concurrently and the shared throttle keeps them within the rate limit
+    range_request_urls = {}
+    for symbol, dates in symbols_to_dates_to_rows.items():
+        range_request_url = get_coingecko_market_chart_range_url(symbol, coingecko_symbols_to_id_configs)
+        if range_request_url:
+            range_request_urls[symbol] = add_coingecko_market_chart_range_params(range_request_url, dates)
 
-        request_url = get_coingecko_request_url(symbol, coingecko_symbols_to_id_configs)
+    with ThreadPoolExecutor(max_workers=COIN_GECKO_REQUEST_CHUNKS) as executor:
+        range_futures = {symbol: executor.submit(get_coingecko_range_costs, range_request_urls[symbol], throttle) for symbol in range_request_urls}
+        try:
+            symbols_to_range_costs = {symbol: range_futures[symbol].result() for symbol in range_futures}
+        except BaseException:
+            #e.g. Ctrl-C, drop the queued requests and stop the running ones instead of waiting on their retries
+            throttle.stop()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
 
-        for date in symbols_to_dates_to_rows[symbol]:
-            if symbol in coingecko_cache and date in coingecko_cache[symbol]:
-                symbols_to_dates_to_costs[symbol][date] = coingecko_cache[symbol][date]
+    try:
+        for symbol, dates in symbols_to_dates_to_rows.items():
+
+            request_url = get_coingecko_request_url(symbol, coingecko_symbols_to_id_configs)
+
+            if not request_url:
+                print("Your CoinGecko symbol config list does not support symbol", symbol)
                 continue
-            else:
-                symbols_to_dates_to_costs[symbol][date] = None
-                if request_url:
+
+            #the per-date /history endpoint is only used for dates the market chart range did not return
+            range_costs = symbols_to_range_costs.get(symbol, {})
+            symbol_cache = coingecko_cache.setdefault(symbol, {})
+
+            #cached dates were removed above, so every date left here needs to be looked up
+            for date in dates:
+                if date in range_costs:
+                    symbol_date_cost = range_costs[date]
+                else:
                     parameterized_url = add_coingecko_request_params(request_url, date)
+                    resp = make_coingecko_api_request(parameterized_url, throttle)
 
-                    backing_off = False
-                    while True:
-                        resp = requests.get(parameterized_url)
-                        try:
-                            resp.raise_for_status()
-                            if backing_off:
-                                print("Backoff succeeded, continuing")
-                        except Exception as err:
-                            if resp.status_code == 429:
-                                print("A CoinGecko API throttle error occurred, self-throttling and trying again")
-                                print("Backing off and trying again in a minute")
-                                time.sleep(COIN_GECKO_THROTTLE_TIME)
-                                coingecko_requests_made = 1
-                                backing_off = True
-                            else:
-                                print("CoinGecko API call failed", err)
-                                print("Backing off and trying again in a minute")
-                                time.sleep(COIN_GECKO_THROTTLE_TIME)
-                                coingecko_requests_made = 1
-                                backing_off = True
-                        else:
-                            backing_off = False
-                            break
-                        
                     #safely get a None value if the json structure is not found in response
                     #this was found during testing of some symbols where they store data but not the USD cost on that date
                     symbol_date_cost = resp.json().get("market_data", {}).get("current_price", {}).get("usd")
-                    symbols_to_dates_to_costs[symbol][date] = symbol_date_cost
-
-                    if symbol in coingecko_cache:
-                        coingecko_cache[symbol][date] = symbols_to_dates_to_costs[symbol][date]
-                    else:
-                        coingecko_cache[symbol] = {}
-                        coingecko_cache[symbol][date] = symbols_to_dates_to_costs[symbol][date]
-
-                    write_coingecko_cache(coingecko_cache, coingecko_cache_file)
 
-                    coingecko_requests_made += 1
-                    #self-throttling to stay under CoinGecko throttle limits
-                    if coingecko_requests_made == COIN_GECKO_REQUEST_CHUNKS:
-                        coingecko_requests_made = 0
-                        time.sleep(COIN_GECKO_THROTTLE_TIME)
-                    else:
-                        time.sleep(1)
-                else:
-                    print("Your CoinGecko symbol config list does not support symbol", symbol)
+                symbol_date_costs[(symbol, date)] = symbol_date_cost
+                symbol_cache[date] = symbol_date_cost
 
-    write_coingecko_cache(coingecko_cache, coingecko_cache_file)
+                append_coingecko_cache(symbol, date, symbol_date_cost, coingecko_cache_file)
+    finally:
+        #compact everything gathered so far into the cache file, even if the run fails or is interrupted part way through
+        write_coingecko_cache(coingecko_cache, coingecko_cache_file)
     print("Finished reaching out to CoinGecko")
 
     missing_coingecko_coverage = {}
 
+    #rows are dicts, so they are updated in place
     for i in key_data_point_indexes:
         row = rows[i]
 
         boughtCurrency = row[symbolColumn]
-        date_key = row[date_column].strftime("%d-%m-%Y")
 
         try:
-            row["usdValue"] = symbols_to_dates_to_costs[boughtCurrency][date_key] * row[valueColumn]
-            if row["usdValue"] < 0.01:
-                row["usdValue"] = 0.01
+            usd_value = symbol_date_costs.get((boughtCurrency, date_keys[i])) * row[valueColumn]
+            row["usdValue"] = 0.01 if usd_value < 0.01 else usd_value
         except:
             missing_coingecko_coverage[i] = {"symbol": boughtCurrency, "date": row[date_column]}
 
-        rows[i] = row
-
+    index_to_costs = {}
     missing_coinhall_coverage = {}
     if missing_coingecko_coverage:
         print("CoinGecko does not provide coverage for the following Symbol + Date combinations:")
@@ -268,41 +390,45 @@ def process_rows(rows, key_data_point_indexes, coingecko_symbols_to_id_configs,
 
         print("Attempting Coinhall fallback API")
 
-        index_to_costs = {}
         print("Reaching out to Coinhall for symbol cost data, this may take a while...")
-        for index in missing_coingecko_coverage:
-            symbol = missing_coingecko_coverage[index]['symbol']
-            date = missing_coingecko_coverage[index]['date']
-            
-            request_url = get_coinhall_request_url(symbol, coinhall_symbols_to_id_configs)
-
-            if request_url:
-                parameterized_url = add_coinhall_request_params(request_url, date, coinhall_symbols_to_id_configs[symbol]["id"])
-                resp = make_coinhall_api_request(parameterized_url, "Error reaching out to CoinGecko, please try again later:", COINHALL_THROTTLE_TIME)
-                data = resp.json()
-                if data and len(data) > 0:
-                    index_to_costs[index] = data[0]
+        coinhall_throttle = CoinhallThrottle()
+        with ThreadPoolExecutor(max_workers=COINHALL_REQUEST_WORKERS) as executor:
+            coinhall_futures = {}
+            for index in missing_coingecko_coverage:
+                symbol = missing_coingecko_coverage[index]['symbol']
+                date = missing_coingecko_coverage[index]['date']
+
+                request_url = get_coinhall_request_url(symbol, coinhall_symbols_to_id_configs)
+
+                if request_url:
+                    parameterized_url = add_coinhall_request_params(request_url, date, coinhall_symbols_to_id_configs[symbol]["id"])
+                    coinhall_futures[index] = executor.submit(get_coinhall_cost, parameterized_url, coinhall_throttle)
                 else:
-                    missing_coinhall_coverage[index] = {"symbol": symbol, "date": date}
-                time.sleep(COINHALL_THROTTLE_TIME)
-            else:
-                print("Your Coinhall symbol config list does not support symbol", symbol)
-                missing_coinhall_coverage[index] = {"symbol": symbol, "date": date}
-        
+                    print("Your Coinhall symbol config list does not support symbol", symbol)
+
+            try:
+                #raise the first failure right away
+                for future in wait(coinhall_futures.values(), return_when=FIRST_EXCEPTION).done:
+                    future.result()
+
+                #collect in row order
+                for index in missing_coingecko_coverage:
+                    cost = coinhall_futures[index].result() if index in coinhall_futures else None
+                    if cost is not None:
+                        index_to_costs[index] = cost
+                    else:
+                        missing_coinhall_coverage[index] = missing_coingecko_coverage[index]
+            except BaseException:
+                #cancel the lookups that have not been sent yet
+                coinhall_throttle.stop()
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
         print("Finished reaching out to Coinhall")
-        for index in index_to_costs:
-            row = rows[index]
-            row["usdValue"] = index_to_costs[index]["high"] * row[valueColumn]
-            if row["usdValue"] < 0.01:
-                row["usdValue"] = 0.01
-            rows[index] = row
 
         if missing_coinhall_coverage:
             print("CoinHall does not provide coverage for the following Symbol + Date combinations:")
             for index in missing_coinhall_coverage:
-                row = rows[index]
-                row["usdValue"] = 0
-                rows[index] = row
                 print(f"\tSymbol: {missing_coinhall_coverage[index]['symbol']}\t\tDate: {missing_coinhall_coverage[index]['date']}\t\t(Excel Row {index + 2})")
         else:
             print("CoinHall provided coverage for all CoinGecko missing symbol/date combinations")
@@ -312,19 +438,24 @@ def process_rows(rows, key_data_point_indexes, coingecko_symbols_to_id_configs,
 
     simplified_rows = []
 
+    #apply the Coinhall fallback values and build the simplified rows in the same pass
     for index in key_data_point_indexes:
         row = rows[index]
+
+        not_covered = index in missing_coinhall_coverage
+
+        if index in index_to_costs:
+            usd_value = index_to_costs[index]["high"] * row[valueColumn]
+            row["usdValue"] = 0.01 if usd_value < 0.01 else usd_value
+        elif not_covered:
+            row["usdValue"] = 0
+
         simplified_row = {header: row[header] for header in simplified_rows_headers}
         if valueColumn in simplified_row and simplified_row[valueColumn] < 0.01:
             simplified_row[valueColumn] = 0.01
-        if index in missing_coinhall_coverage:
-            simplified_row["comment"] = "Not covered, fixme"
-        else:
-            simplified_row["comment"] = ""
+        simplified_row["comment"] = "Not covered, fixme" if not_covered else ""
         simplified_rows.append(simplified_row)
 
-
-
     return rows, simplified_rows
 
 #creates chunks of symbols and dates to send for API processing
@@ -354,12 +485,49 @@ def get_coingecko_request_url(symbol, coingecko_symbols_to_id_configs):
 
     if symbol in coingecko_symbols_to_id_configs:
         coingecko_request_id = coingecko_symbols_to_id_configs[symbol]["id"]
-        coingecko_request_url =  COIN_GECKO_API_URL + COIN_GECKO_COINS_ENDPOINT + COIN_GECKO_HISTORICAL_ENDPOINT.replace("<coin-id>", coingecko_request_id)
+        coingecko_request_url =  COIN_GECKO_API_URL + COIN_GECKO_COINS_ENDPOINT + COIN_GECKO_HISTORICAL_ENDPOINT.format(coin_id=coingecko_request_id)
 
     return coingecko_request_url
 
+#localization=false leaves the coin name translations out of the response, only the price is used
 def add_coingecko_request_params(request_url, date):
-    return request_url + f"?date={date}"
+    return request_url + f"?date={date}&localization=false"
+
+def get_coingecko_market_chart_range_url(symbol, coingecko_symbols_to_id_configs):
+    coingecko_request_url = None
+
+    if symbol in coingecko_symbols_to_id_configs:
+        coingecko_request_id = coingecko_symbols_to_id_configs[symbol]["id"]
+        coingecko_request_url = COIN_GECKO_API_URL + COIN_GECKO_COINS_ENDPOINT + COIN_GECKO_MARKET_CHART_RANGE_ENDPOINT.format(coin_id=coingecko_request_id)
+
+    return coingecko_request_url
+
+#covers the start of the earliest date through the end of the latest date, dates are dd-mm-yyyy UTC days
+def add_coingecko_market_chart_range_params(request_url, dates):
+    days = [datetime.datetime.strptime(date, "%d-%m-%Y").replace(tzinfo=datetime.timezone.utc) for date in dates]
+
+    from_unix = str(int(min(days).timestamp()))
+    to_unix = str(int(max(days).timestamp()) + 86400)
+
+    return request_url + COIN_GECKO_MARKET_CHART_RANGE_PARAMS.format(from_time=from_unix, to_time=to_unix)
+
+#a range CoinGecko refuses outright (e.g. older than the public API allows) returns no prices, so its dates fall back to /history
+def get_coingecko_range_costs(request_url, throttle):
+    resp = make_coingecko_api_request(request_url, throttle, give_up_on_client_error=True)
+    if resp is None:
+        return {}
+    return get_coingecko_daily_prices(resp.json().get("prices", []))
+
+#buckets market chart prices ([unix ms, price] pairs) into dd-mm-yyyy UTC days, keeping the first price of each day
+#this lines up with /history, which reports the price at 00:00 UTC of the requested date
+def get_coingecko_daily_prices(prices):
+    daily_prices = {}
+    for timestamp, price in prices:
+        date = datetime.datetime.fromtimestamp(timestamp / 1000, datetime.timezone.utc).strftime("%d-%m-%Y")
+        if date not in daily_prices:
+            daily_prices[date] = price
+
+    return daily_prices
 
 def get_coinhall_request_url(symbol, coinhall_symbols_to_id_configs):
     coinhall_request_url = None
@@ -376,20 +544,55 @@ def add_coinhall_request_params(request_url, date, symbol_id):
     from_unix = str(int(time.mktime(from_date.timetuple())))
     to_unix = str(int(time.mktime(to_date.timetuple())))
 
-    return request_url + COINHALL_HISTORICAL_PARAMS.replace("<from-time>", from_unix).replace("<to-time>", to_unix).replace("<coin-id>", symbol_id)
+    return request_url + COINHALL_HISTORICAL_PARAMS.format(from_time=from_unix, to_time=to_unix, coin_id=symbol_id)
 
-def make_coinhall_api_request(request_url, error_string, throttle_time):
-    resp = requests.get(request_url)
+#returns the first daily candle Coinhall has for the request, or None if it has no data
+def get_coinhall_cost(request_url, throttle):
+    throttle.acquire()
+    resp = make_coinhall_api_request(request_url, "Error reaching out to CoinGecko, please try again later:", throttle)
+    data = resp.json()
+    if data and len(data) > 0:
+        return data[0]
+    return None
+
+#retries until CoinGecko answers, backing off a full throttle window after any failure
+#every request goes through the throttle, which starts a fresh window after a backoff
+#with give_up_on_client_error, a 4xx other than 429 will not succeed on retry, so None is returned instead
+def make_coingecko_api_request(request_url, throttle, give_up_on_client_error=False):
+    backed_off = False
+    while True:
+        throttle.acquire()
+        resp = None
+        try:
+            resp = SESSION.get(request_url, timeout=REQUEST_TIMEOUT)
+            resp.raise_for_status()
+        except Exception as err:
+            if resp is not None and resp.status_code == 429:
+                print("A CoinGecko API throttle error occurred, self-throttling and trying again")
+            else:
+                print("CoinGecko API call failed", err)
+                if give_up_on_client_error and resp is not None and 400 <= resp.status_code < 500:
+                    return None
+            print("Backing off and trying again in a minute")
+            throttle.backoff()
+            backed_off = True
+        else:
+            if backed_off:
+                print("Backoff succeeded, continuing")
+            return resp
+
+def make_coinhall_api_request(request_url, error_string, throttle):
     try:
+        resp = SESSION.get(request_url, timeout=REQUEST_TIMEOUT)
         resp.raise_for_status()
     except requests.HTTPError as err:
         #if throttled, wait for the throttle to end and retry
         if resp.status_code == 429:
-            time.sleep(throttle_time)
-            resp = requests.get(request_url)
+            throttle.acquire()
 
             #give up after 1 retry
             try:
+                resp = SESSION.get(request_url, timeout=REQUEST_TIMEOUT)
                 resp.raise_for_status()
             except Exception as err:
                 print(error_string, err)
@@ -401,6 +604,8 @@ def make_coinhall_api_request(request_url, error_string, throttle_time):
         print(error_string, err)
         sys.exit(1)
 
+    return resp
+
 def count_symbol_totals(rows, key_data_point_indexes, symbol_column, value_column):
     print("Counting symbol totals")
     symbols_to_totals = {}
@@ -425,48 +630,40 @@ def process_symbol_totals(symbols_to_totals):
 def output_rows(title, headers, rows, fname, format, sum_header=None):
     if format == "xlsx":
         print("Creating new Excel file", fname)
-        wb = Workbook()
-        ws1 = wb.active
-        ws1.title = title
+        #Write-only workbooks stream rows out as they are appended instead of keeping every cell object around until save
+        wb = Workbook(write_only=True)
+        ws1 = wb.create_sheet(title)
 
         ws1.append(headers)
 
+        #rows may be a generator, so they are counted as they are written
+        num_rows = 0
         for row in rows:
-            data = []
-            for header in headers:
-                if header in row:
-                    data.append(row[header])
-                else:
-                    data.append(None)
-            ws1.append(data)
+            ws1.append([row.get(header) for header in headers])
+            num_rows += 1
 
         if sum_header and sum_header in headers:
-            index = headers.index(sum_header) + 1
-            column = get_column_letter(index)
+            index = headers.index(sum_header)
+            column = get_column_letter(index + 1)
 
             first_row = column + "2"
-            last_row = column + str(len(ws1[column]))
+            last_row = column + str(num_rows + 1)
 
             sum_formula = f"= SUM({first_row}:{last_row})"
 
-            sum_formula_cell = column + str(len(ws1[column]) + 1)
-            ws1[sum_formula_cell] = sum_formula
+            sum_formula_row = [None] * len(headers)
+            sum_formula_row[index] = sum_formula
+            ws1.append(sum_formula_row)
 
         wb.save(fname)
 
     elif format == "csv":
         print(f"Creating new CSV file {fname}")
-        with open(fname, 'w') as csvfile:
-            csvwriter = csv.writer(csvfile)
-            csvwriter.writerow(headers)
-            for row in rows:
-                data = []
-                for header in headers:
-                    if header in row:
-                        data.append(row[header])
-                    else:
-                        data.append("")
-                csvwriter.writerow(data)
+        with open(fname, 'w', newline='', buffering=1 << 20) as csvfile:
+            #DictWriter maps each row onto the headers itself, filling missing columns with "" and ignoring extra keys
+            csvwriter = csv.DictWriter(csvfile, fieldnames=headers, extrasaction='ignore', restval='')
+            csvwriter.writeheader()
+            csvwriter.writerows(rows)
 
 def process(args):
 
@@ -516,8 +713,12 @@ def process(args):
     # }
     coinhall_symbols_to_id_configs = load_config_file(args.coinhall_symbol_to_id_file)
 
-    title, headers, rows = parse_input_data(args.input_file)
-    key_data_point_indexes = get_key_data_point_indexes(rows, args.date_column, args.year_filter)
+    title, headers, row_values = parse_input_data(args.input_file)
+
+    #key rows by their index in the input, the rest of the pipeline only ever touches these
+    rows = dict(stream_key_rows(row_values, headers, args.date_column, args.year_filter))
+    key_data_point_indexes = list(rows)
+    date_keys = get_date_keys(rows, key_data_point_indexes, args.date_column)
 
     count_totals = count_symbol_totals(rows, key_data_point_indexes, args.symbol_column, args.value_column)
     count_rows = process_symbol_totals(count_totals)
@@ -525,21 +726,28 @@ def process(args):
     output_rows(title, ["symbol", "total"], count_rows, args.output_file + f"-symbol-totals.{args.output_format}", args.output_format)
 
     simplified_rows_headers = [args.date_column, args.symbol_column, args.value_column, "usdValue"]
-    rows, simplified_rows = process_rows(rows, key_data_point_indexes, coingecko_symbols_to_id_configs, coinhall_symbols_to_id_configs, args.date_column, args.symbol_column, args.value_column, simplified_rows_headers, coingecko_cache, args.coingecko_cache)
-    headers.append("usdValue")
+    rows, simplified_rows = process_rows(rows, key_data_point_indexes, date_keys, coingecko_symbols_to_id_configs, coinhall_symbols_to_id_configs, args.date_column, args.symbol_column, args.value_column, simplified_rows_headers, coingecko_cache, args.coingecko_cache)
+    output_headers = headers + ["usdValue"]
     simplified_rows_headers.append("comment")
 
-    output_rows(title, headers, rows, args.output_file, args.output_format)
+    output_rows(title, output_headers, iter_output_rows(row_values, headers, rows), args.output_file, args.output_format)
     output_rows(title, simplified_rows_headers, simplified_rows, args.output_file + f"-simplified.{args.output_format}", args.output_format, sum_header="usdValue")
 
-def import_symbol_coingecko_worker(symbol, config_file):
-    print(f"Searching CoinGecko for symbol {symbol}")
+def get_coingecko_coins_list(coins_list_cache_file):
+    if exists(coins_list_cache_file) and time.time() - os.path.getmtime(coins_list_cache_file) < COIN_GECKO_COINS_LIST_CACHE_TIME:
+        print(f"Found CoinGecko coin list cache file {coins_list_cache_file}, loading...")
+        #read as bytes so json detects the UTF-8 encoding the response was saved in, whatever the locale
+        try:
+            with open(coins_list_cache_file, 'rb') as fp:
+                return json.load(fp)
+        except ValueError:
+            #e.g. a write that was cut off, treat it like a stale cache
+            print(f"CoinGecko coin list cache file {coins_list_cache_file} could not be read, fetching a new copy...")
 
-    #TODO: Cache this as well for later use? Would want to stat the config file and reload the list if its pretty old
-    resp = requests.get(COIN_GECKO_API_URL + COIN_GECKO_COINS_ENDPOINT + COIN_GECKO_COINS_LIST_ENDPOINT)
     try:
+        resp = SESSION.get(COIN_GECKO_API_URL + COIN_GECKO_COINS_ENDPOINT + COIN_GECKO_COINS_LIST_ENDPOINT, timeout=REQUEST_TIMEOUT)
         resp.raise_for_status()
-    except requests.HTTPError as err:
+    except requests.RequestException as err:
         print(err)
         raise CaughtError("Error reaching out to CoinGecko API List endpoint, please try again in a minute or two.")
     except Exception as err:
@@ -547,10 +755,23 @@ def import_symbol_coingecko_worker(symbol, config_file):
 
     data = resp.json()
 
+    #the raw response body is already JSON, so it is saved as-is instead of being re-encoded
+    with open(coins_list_cache_file, 'wb') as fp:
+        fp.write(resp.content)
+
+    return data
+
+def import_symbol_coingecko_worker(symbol, config_file, coins_list_cache_file):
+    print(f"Searching CoinGecko for symbol {symbol}")
+
+    data = get_coingecko_coins_list(coins_list_cache_file)
+
+    symbol_lower = symbol.lower()
+
     possible_options = []
     #basic O(n*m) string search, super slow
     for symbol_config in data:
-        if symbol in symbol_config["symbol"] or symbol.lower() in symbol_config["symbol"]:
+        if symbol in symbol_config["symbol"] or symbol_lower in symbol_config["symbol"]:
             possible_options.append(symbol_config)
 
     if len(possible_options) == 0:
@@ -566,7 +787,11 @@ def import_symbol_coingecko_worker(symbol, config_file):
     #Rank possible options from least likely to most likely
     possible_option_ranks = []
     for possible_option in possible_options:
-        dist = levenshtein_dist_dp(symbol.lower(), possible_option["symbol"])
+        #When the lowercased symbol appears inside the candidate, the only edits needed are insertions, so the distance is the length difference
+        if symbol_lower in possible_option["symbol"]:
+            dist = len(possible_option["symbol"]) - len(symbol_lower)
+        else:
+            dist = levenshtein_dist_bitparallel(symbol_lower, possible_option["symbol"])
         possible_option_ranks.append((possible_option, dist))
     
     #sort by rank
@@ -647,32 +872,47 @@ def import_symbol(args):
 
     #TODO: Add coinhall?
     if api_type == "coingecko":
-        import_symbol_coingecko_worker(symbol, config_file)
+        import_symbol_coingecko_worker(symbol, config_file, args.coins_list_cache)
             
-#Pulled from https://github.com/pharr117/levenshtein_dist 
+#Myers' bit-parallel Levenshtein distance, in the form given by Hyyrö
 #A general string comparison algorithm: given a source string and a target string, calculates the distance between them
 #Returns a rank, the lower the rank the closer the words match.
-def levenshtein_dist_dp(source, target):
+#Each column of the DP matrix is kept as bit vectors of vertical +1/-1 deltas, so a whole column is updated with a handful of integer ops per target character
+def levenshtein_dist_bitparallel(source, target):
 
     len_source = len(source)
-    len_target = len(target)
-    matrix = [[None for j in range(len_target+1)] for i in range(len_source+1)]
-
-    for i in range(len_source + 1):
-        for j in range(len_target+1):
-            if i == 0:
-                matrix[i][j] = j
-            elif j == 0:
-                matrix[i][j] = i
-            else:
-                if source[i-1] == target[j-1]:
-                    matrix[i][j] = matrix[i-1][j-1]
-                else:
-                    matrix[i][j] = 1 + min(matrix[i][j-1],
-                                           matrix[i-1][j],
-                                           matrix[i-1][j-1])
-
-    return matrix[len_source][len_target]
+    if len_source == 0:
+        return len(target)
+
+    #bitmask of the positions each character appears at in source
+    char_masks = {}
+    for i, source_char in enumerate(source):
+        char_masks[source_char] = char_masks.get(source_char, 0) | (1 << i)
+
+    mask = (1 << len_source) - 1
+    last_bit = 1 << (len_source - 1)
+    positive_vertical = mask
+    negative_vertical = 0
+    dist = len_source
+
+    for target_char in target:
+        eq = char_masks.get(target_char, 0)
+        x_vertical = eq | negative_vertical
+        x_horizontal = (((eq & positive_vertical) + positive_vertical) ^ positive_vertical) | eq
+        positive_horizontal = negative_vertical | ~(x_horizontal | positive_vertical)
+        negative_horizontal = positive_vertical & x_horizontal
+
+        if positive_horizontal & last_bit:
+            dist += 1
+        elif negative_horizontal & last_bit:
+            dist -= 1
+
+        positive_horizontal = (positive_horizontal << 1) | 1
+        negative_horizontal = negative_horizontal << 1
+        positive_vertical = (negative_horizontal | ~(x_vertical | positive_horizontal)) & mask
+        negative_vertical = positive_horizontal & x_vertical
+
+    return dist
 
 def main():
     args = parse_args(process, import_symbol)